@@ -0,0 +1,82 @@
+"""Download handlers which record how much time goes into setting up connections to Goodreads"""
+import time
+
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
+from scrapy.core.downloader.handlers.http2 import H2DownloadHandler
+from scrapy.core.http2.agent import H2ConnectionPool
+from twisted.web.client import HTTPConnectionPool
+
+
+def record_new_connection(stats, start_time: float):
+    setup_ms = round((time.monotonic() - start_time) * 1000)
+    stats.inc_value("download_profile/new_connections")
+    stats.inc_value("download_profile/connection_setup_ms", setup_ms)
+    stats.max_value("download_profile/connection_setup_ms_max", setup_ms)
+
+
+class StatsConnectionPool(HTTPConnectionPool):
+    """
+    Connection pool which records every new connection and how long it took to connect (DNS lookup included) in the
+    crawl stats. Requests which reuse a pooled connection don't show up here, so compare new connections against
+    downloader/request_count to see how well connections are being reused.
+    """
+
+    def __init__(self, reactor, stats, persistent=True):
+        super().__init__(reactor, persistent=persistent)
+        self.stats = stats
+
+    @classmethod
+    def from_pool(cls, pool: HTTPConnectionPool, stats):
+        """Replaces a pool which hasn't been used yet with a StatsConnectionPool configured the same way"""
+        from twisted.internet import reactor
+
+        stats_pool = cls(reactor, stats, persistent=pool.persistent)
+        stats_pool.maxPersistentPerHost = pool.maxPersistentPerHost
+        stats_pool.cachedConnectionTimeout = pool.cachedConnectionTimeout
+        stats_pool.retryAutomatically = pool.retryAutomatically
+        pool.closeCachedConnections()
+        return stats_pool
+
+    def _newConnection(self, key, endpoint):
+        start_time = time.monotonic()
+
+        def record_connection(connection):
+            record_new_connection(self.stats, start_time)
+            return connection
+
+        return super()._newConnection(key, endpoint).addCallback(record_connection)
+
+
+class StatsH2ConnectionPool(H2ConnectionPool):
+    """Same as StatsConnectionPool for the HTTP/2 handler, which sends every request to a host over one connection"""
+
+    def __init__(self, reactor, settings, stats):
+        super().__init__(reactor, settings)
+        self.stats = stats
+
+    def _new_connection(self, key, uri, endpoint):
+        start_time = time.monotonic()
+
+        def record_connection(connection):
+            record_new_connection(self.stats, start_time)
+            return connection
+
+        # Only the request which opened the connection gets this deferred, the ones queued behind it get their own
+        return super()._new_connection(key, uri, endpoint).addCallback(record_connection)
+
+
+class StatsHTTP11DownloadHandler(HTTP11DownloadHandler):
+    def __init__(self, settings, crawler=None):
+        super().__init__(settings, crawler)
+        if crawler:
+            self._pool = StatsConnectionPool.from_pool(self._pool, crawler.stats)
+
+
+class StatsH2DownloadHandler(H2DownloadHandler):
+    def __init__(self, settings, crawler=None):
+        super().__init__(settings, crawler)
+        if crawler:
+            from twisted.internet import reactor
+
+            # The parent's pool doesn't hold any connections until the first request, so it can just be swapped out
+            self._pool = StatsH2ConnectionPool(reactor, settings, crawler.stats)
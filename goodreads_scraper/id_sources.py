@@ -0,0 +1,95 @@
+"""Lazily read the IDs a spider starts from, so job size isn't limited by what fits in a POST body or in RAM"""
+import gzip
+import json
+import logging
+import os
+import re
+from typing import Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+RANGE_REGEX = re.compile(r"^range:(\d+)-(\d+)$")
+NDJSON_SUFFIXES = (".ndjson", ".jsonl", ".ndjson.gz", ".jsonl.gz")
+
+# Crawl the ID source in order. The disk queue is only used when running with JOBDIR set
+FIFO_SCHEDULER_SETTINGS = {'SCHEDULER_DISK_QUEUE': 'scrapy.squeues.PickleFifoDiskQueue',
+                           'SCHEDULER_MEMORY_QUEUE': 'scrapy.squeues.FifoMemoryQueue'}
+
+
+def check_id_source(id_source: str):
+    """Fails straight away on an ID source which can't be read, instead of once the crawl is already running"""
+    if RANGE_REGEX.match(id_source):
+        return
+    if not os.path.isfile(id_source) or not os.access(id_source, os.R_OK):
+        raise ValueError(f"id_source {id_source} is not a range or a readable file")
+
+
+def iter_ids(id_source: str, id_key: str, stats=None) -> Iterator[str]:
+    """
+    Yields IDs one at a time from an ID source, which can be one of
+
+    - `range:<start>-<end>`: every ID between start and end, inclusive
+    - A `.ndjson` / `.jsonl` file (optionally gzipped): one JSON object per line with the ID under id_key, or a bare ID
+    - Any other file path (optionally gzipped): one ID per line, comma separated lines are also fine
+
+    Lines which can't be decoded are skipped and counted under id_source/invalid_lines, so one bad line doesn't end
+    the whole job.
+
+    :param id_source: The ID source as passed in the crawl arguments
+    :param id_key: The key to look the ID up under in NDJSON objects, e.g. book_id
+    :param stats: (Optional) Crawl stats to count skipped lines in
+    """
+    range_match = RANGE_REGEX.match(id_source)
+    if range_match:
+        start, end = int(range_match.group(1)), int(range_match.group(2))
+        for id_value in range(start, end + 1):
+            yield str(id_value)
+        return
+
+    is_ndjson = id_source.endswith(NDJSON_SUFFIXES)
+    opener = gzip.open if id_source.endswith(".gz") else open
+    with opener(id_source, "rb") as id_file:
+        for line_number, raw_line in enumerate(id_file, start=1):
+            try:
+                line = raw_line.decode("utf-8").strip()
+                if not line:
+                    continue
+                if is_ndjson:
+                    record = json.loads(line)
+                    id_value = record.get(id_key) if isinstance(record, dict) else record
+                    if id_value is None:
+                        raise ValueError(f"no {id_key} in record")
+                    yield str(id_value)
+                else:
+                    for id_value in line.split(","):
+                        id_value = id_value.strip()
+                        if id_value:
+                            yield id_value
+            except ValueError as e:
+                # JSONDecodeError and UnicodeDecodeError are both ValueErrors
+                logger.warning(f"Skipping invalid line {line_number} of {id_source}: {e}")
+                if stats:
+                    stats.inc_value("id_source/invalid_lines")
+
+
+class IdSourceMixin(object):
+    """Start requests for spiders which take either a comma delimited list of IDs or an id_source crawl arg"""
+
+    # The key IDs are stored under in NDJSON ID sources, e.g. book_id
+    id_key = None
+    id_source = None
+
+    def iter_start_ids(self) -> Iterable[str]:
+        # Scrapy only pulls the next start request once the downloader has room for it, so reading the ID source
+        # lazily keeps memory flat no matter how many IDs it holds
+        if not self.id_source:
+            yield from self.start_urls
+            return
+
+        try:
+            yield from iter_ids(self.id_source, self.id_key, self.crawler.stats)
+        except (OSError, EOFError) as e:
+            # Scrapy would only log this and finish the crawl as if every ID had been read, so close it with a reason
+            # which shows the job was cut short
+            logger.error(f"Failed to read id_source {self.id_source}: {e!r}")
+            self.crawler.engine.close_spider(self, "id_source_error")
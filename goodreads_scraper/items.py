@@ -86,6 +86,15 @@ class BookItem(scrapy.Item):
     genres = Field(output_processor=Compose(set, list))
 
 
+class BookStatsItem(scrapy.Item):
+    book_id = Field(serializer=int)
+    scrape_time = Field()
+    num_ratings = Field()
+    num_reviews = Field()
+    avg_rating = Field()
+    rating_histogram = Field()
+
+
 class UserReviewItem(scrapy.Item):
     user_id = Field()
     book_id = Field()
@@ -98,5 +107,21 @@ class UserReviewLoader(ItemLoader):
     default_output_processor = TakeFirst()
 
 
+class BookReviewAggregateItem(scrapy.Item):
+    book_id = Field()
+    num_reviews = Field()
+    avg_rating = Field()
+    rating_histogram = Field()
+    read_year_histogram = Field()
+
+
+class UserReviewAggregateItem(scrapy.Item):
+    user_id = Field()
+    num_reviews = Field()
+    avg_rating = Field()
+    rating_histogram = Field()
+    read_year_histogram = Field()
+
+
 class UserProfileItem(scrapy.Item):
     user_id = Field()
@@ -0,0 +1,15 @@
+import logging
+
+from scrapy import logformatter
+
+from .pipelines import AggregatedReview
+
+
+class GoodreadsLogFormatter(logformatter.LogFormatter):
+    def dropped(self, item, exception, response, spider):
+        log_kwargs = super().dropped(item, exception, response, spider)
+        # The ReviewAggregationPipeline drops every raw review it aggregates, which would otherwise log a warning with
+        # the whole item for each one of them
+        if isinstance(exception, AggregatedReview):
+            log_kwargs["level"] = logging.DEBUG
+        return log_kwargs
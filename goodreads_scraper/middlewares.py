@@ -3,11 +3,16 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import logging
+
 from scrapy import signals
+from scrapy.downloadermiddlewares.httpcompression import ACCEPTED_ENCODINGS
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+logger = logging.getLogger(__name__)
+
 
 class GoodreadsScraperSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +106,33 @@ class GoodreadsScraperDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class DownloadStatsMiddleware:
+    # Runs right next to the downloader, before HttpCompressionMiddleware has decompressed the body, so the sizes
+    # recorded here are what actually went over the wire. Compare them with httpcompression/response_bytes to see how
+    # much compression saves.
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # Scrapy only asks for brotli when the package can be imported, and falls back to gzip/deflate silently
+        if b"br" not in ACCEPTED_ENCODINGS:
+            logger.warning("brotli is not installed, responses will only be gzip/deflate compressed")
+        return cls(crawler.stats)
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def process_response(self, request, response, spider):
+        content_encoding = response.headers.get("Content-Encoding", b"identity").decode("latin-1").lower()
+        self.stats.inc_value(f"download_profile/wire_bytes/{content_encoding}", len(response.body))
+        self.stats.inc_value(f"download_profile/response_count/{content_encoding}")
+        if response.protocol:
+            self.stats.inc_value(f"download_profile/protocol/{response.protocol}")
+
+        download_latency = request.meta.get("download_latency")
+        if download_latency is not None:
+            latency_ms = round(download_latency * 1000)
+            self.stats.inc_value("download_profile/latency_ms", latency_ms)
+            self.stats.max_value("download_profile/latency_ms_max", latency_ms)
+        return response
@@ -1,12 +1,24 @@
 # -*- coding: utf-8 -*-
+import gzip
 import json
 import logging
-from concurrent import futures
-from typing import Callable, Dict, List, Any
+import os
+import time
+import uuid
+from typing import Dict, List, Any
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from google.cloud import pubsub_v1
+from itemadapter import ItemAdapter
 from pydantic import BaseModel
-from scrapy import signals
+from scrapy import Request, signals
+from scrapy.exceptions import DontCloseSpider, DropItem
+from twisted.internet import task, threads
+
+from .items import BookReviewAggregateItem, UserReviewAggregateItem, UserReviewItem
+from .spool import acquire_spool, release_spool
 
 # Define your item pipelines here
 #
@@ -14,11 +26,83 @@ from scrapy import signals
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
 MAX_ITEM_COUNT = 100
+INITIAL_REVIEW_CAPACITY = 1024
+UNKNOWN_READ_YEAR = "unknown"
+# How often the FileSinkPipeline checks for partitions which have been open too long without new items
+ROTATION_CHECK_SECONDS = 60
 
 logger = logging.getLogger(__name__)
 
+# Parquet needs a fixed schema per file, and letting pyarrow infer it from the first row group breaks as soon as a
+# column happens to be all nulls in that batch. Item types without a schema here are only written as NDJSON.
+PARQUET_SCHEMAS = {
+    "BookItem": pa.schema([
+        ("book_id", pa.int64()),
+        ("book_url", pa.string()),
+        ("book_title", pa.string()),
+        ("image_url", pa.string()),
+        ("author", pa.string()),
+        ("author_url", pa.string()),
+        ("book_description", pa.string()),
+        ("scrape_time", pa.string()),
+        ("work_internal_id", pa.string()),
+        ("work_id", pa.int64()),
+        ("publish_date", pa.string()),
+        ("original_title", pa.string()),
+        ("num_ratings", pa.int64()),
+        ("num_reviews", pa.int64()),
+        ("avg_rating", pa.float64()),
+        ("rating_histogram", pa.list_(pa.int64())),
+        ("num_pages", pa.int64()),
+        ("language", pa.string()),
+        ("isbn", pa.string()),
+        ("isbn13", pa.string()),
+        ("asin", pa.string()),
+        ("series", pa.string()),
+        ("genres", pa.list_(pa.string())),
+    ]),
+    "BookStatsItem": pa.schema([
+        ("book_id", pa.int64()),
+        ("scrape_time", pa.string()),
+        ("num_ratings", pa.int64()),
+        ("num_reviews", pa.int64()),
+        ("avg_rating", pa.float64()),
+        ("rating_histogram", pa.list_(pa.int64())),
+    ]),
+    "UserReviewItem": pa.schema([
+        ("user_id", pa.string()),
+        ("book_id", pa.string()),
+        ("user_rating", pa.string()),
+        ("date_read", pa.string()),
+        ("scrape_time", pa.string()),
+    ]),
+    "BookReviewAggregateItem": pa.schema([
+        ("book_id", pa.string()),
+        ("num_reviews", pa.int64()),
+        ("avg_rating", pa.float64()),
+        ("rating_histogram", pa.list_(pa.int64())),
+        ("read_year_histogram", pa.map_(pa.string(), pa.int64())),
+    ]),
+    "UserReviewAggregateItem": pa.schema([
+        ("user_id", pa.string()),
+        ("num_reviews", pa.int64()),
+        ("avg_rating", pa.float64()),
+        ("rating_histogram", pa.list_(pa.int64())),
+        ("read_year_histogram", pa.map_(pa.string(), pa.int64())),
+    ]),
+    "UserProfileItem": pa.schema([
+        ("user_id", pa.string()),
+    ]),
+}
+
+
+class AggregatedReview(DropItem):
+    """Raised for raw reviews the ReviewAggregationPipeline has folded into its aggregates"""
+
 
 class BatchRequest(BaseModel):
+    # Several item types can go to the same topic, e.g. from the user_books spider, so every batch only holds one type
+    item_type: str
     items: List[Dict[str, Any]]
 
 
@@ -30,8 +114,16 @@ class PubsubPipeline(object):
     def __init__(self, crawler):
         self.publisher = None
         self.topic_path = None
-        self.items: List[Dict[str, Any]] = []
+        self.spool = None
+        self.items: Dict[str, List[Dict[str, Any]]] = {}
+        self.spool_dir = crawler.settings.get("PUBSUB_SPOOL_DIR")
+        self.spool_segment_bytes = crawler.settings.getint("PUBSUB_SPOOL_SEGMENT_BYTES")
+        self.spool_close_timeout = crawler.settings.getint("PUBSUB_SPOOL_CLOSE_TIMEOUT")
+        self.publish_timeout = crawler.settings.getint("PUBSUB_PUBLISH_TIMEOUT")
+        self.max_publishes_in_flight = crawler.settings.getint("PUBSUB_MAX_PUBLISHES_IN_FLIGHT")
         crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        # Finish up once every pipeline has closed, see ReviewAggregationPipeline.close_spider
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
 
     def spider_opened(self, spider):
         project_id = spider.custom_settings.get("GCP_PROJECT_ID")
@@ -39,6 +131,11 @@ class PubsubPipeline(object):
         if project_id and topic_name:
             self.publisher = pubsub_v1.PublisherClient()
             self.topic_path = self.publisher.topic_path(project_id, topic_name)
+            # Batches go to disk first and get published in the background, anything left over from a previous run
+            # against the same topic is replayed before the new batches
+            self.spool = acquire_spool(os.path.join(self.spool_dir, project_id, topic_name), self.publisher,
+                                       self.topic_path, self.spool_segment_bytes, self.publish_timeout,
+                                       self.max_publishes_in_flight)
         else:
             # For whatever reason, you can't modify the pipelines at __init__ parameters in the spider, so I have to
             # short circuit the initialization of the GCP subscriber, and also skip the pipeline on each item
@@ -51,43 +148,385 @@ class PubsubPipeline(object):
             logging.info("Skipping pub/sub pipeline")
             return item
 
-        self.items.append(item)
+        item_type = type(item).__name__
+        items = self.items.setdefault(item_type, [])
+        items.append(item)
 
-        if len(self.items) >= MAX_ITEM_COUNT:
-            self.send_batch(self.items)
-            self.items = []
+        if len(items) >= MAX_ITEM_COUNT:
+            self.send_batch(item_type, items)
+            self.items[item_type] = []
 
         return item
 
-    def close_spider(self, spider):
-        if len(self.items) > 0:
-            self.send_batch(self.items)
+    def spider_closed(self, spider):
+        if not self.spool:
+            return
+        for item_type, items in self.items.items():
+            if len(items) > 0:
+                self.send_batch(item_type, items)
+        # Waiting for the spool to drain blocks, so keep it off the reactor thread
+        return threads.deferToThread(release_spool, self.spool, self.spool_close_timeout)
 
-    def send_batch(self, items: List[Dict[str, Any]]):
-        publish_futures = []
-        batch_request = BatchRequest(items=items)
+    def send_batch(self, item_type: str, items: List[Dict[str, Any]]):
+        batch_request = BatchRequest(item_type=item_type, items=items)
         data = str(json.dumps(batch_request.dict()))
-        publish_future = self.publisher.publish(self.topic_path, data=data.encode("utf-8"))
-        publish_future.add_done_callback(self.get_callback(publish_future, data))
-        publish_futures.append(publish_future)
-        futures.wait(publish_futures, return_when=futures.ALL_COMPLETED)
-        logging.info("Sent {} items to PubSub".format(len(items)))
+        self.spool.append(data.encode("utf-8"))
+        logging.info("Spooled {} {}s for PubSub".format(len(items), item_type))
 
-    @staticmethod
-    def get_callback(
-            publish_future: pubsub_v1.publisher.futures.Future, data: str
-    ) -> Callable[[pubsub_v1.publisher.futures.Future], None]:
-        """
-        Taken from the GCP documentation page on publishing to PubSub topics. I have no idea what this code monstrosity
-        is doing...
-        https://cloud.google.com/pubsub/docs/publisher
-        """
-
-        def callback(publish_future: pubsub_v1.publisher.futures.Future) -> None:
+
+class RollingPartition(object):
+    """
+    Rolling output files for a single item type. Rows are buffered in memory and written out once the buffer is full,
+    NDJSON rows are appended to a gzipped file and every flush becomes one Parquet row group. Files are written with an
+    `.inprogress` suffix and only renamed once they are closed, so a bulk loader watching the directory never picks up
+    a half written file.
+    """
+
+    def __init__(self, directory: str, item_type: str, run_id: str, formats: List[str], buffer_size: int,
+                 max_bytes: int, max_seconds: int):
+        self.directory = os.path.join(directory, item_type)
+        self.item_type = item_type
+        self.run_id = run_id
+        self.schema = PARQUET_SCHEMAS.get(item_type)
+        self.write_ndjson = "ndjson" in formats
+        self.write_parquet = "parquet" in formats and self.schema is not None
+        self.buffer_size = buffer_size
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+
+        self.rows: List[Dict[str, Any]] = []
+        self.buffered_at = None
+        self.file_count = 0
+        self.opened_at = None
+        self.bytes_written = 0
+        self.ndjson_file = None
+        self.parquet_writer = None
+        self.in_progress_paths: List[str] = []
+
+        if "parquet" in formats and self.schema is None:
+            logger.warning(f"No parquet schema defined for {item_type}, only writing NDJSON")
+        os.makedirs(self.directory, exist_ok=True)
+
+    def add(self, row: Dict[str, Any]):
+        if not self.rows:
+            self.buffered_at = time.monotonic()
+        self.rows.append(row)
+        if len(self.rows) >= self.buffer_size or self._should_rotate():
+            self.flush()
+
+    def flush(self):
+        # Always take the rows out of the buffer first, so one bad batch can't get written over and over again
+        rows, self.rows = self.rows, []
+        self.buffered_at = None
+        table = None
+        if rows and self.write_parquet:
+            rows, table = self._to_table(rows)
+
+        if rows:
+            if self.opened_at is None:
+                self._open()
+
+            if self.write_ndjson:
+                lines = "".join(json.dumps(row) + "\n" for row in rows)
+                self.ndjson_file.write(lines)
+                self.bytes_written += len(lines)
+            if table is not None:
+                self.parquet_writer.write_table(table)
+                if not self.write_ndjson:
+                    self.bytes_written += table.nbytes
+
+        if self._should_rotate():
+            self.close()
+
+    def rotate_if_stale(self):
+        """Writes out and closes the partition once it is max_seconds old, even if no new rows have come in since"""
+        started_at = self.opened_at if self.opened_at is not None else self.buffered_at
+        if started_at is not None and time.monotonic() - started_at >= self.max_seconds:
+            self.flush()
+            self.close()
+
+    def _to_table(self, rows: List[Dict[str, Any]]):
+        try:
+            return rows, pa.Table.from_pylist(rows, schema=self.schema)
+        except (pa.ArrowException, TypeError, ValueError):
+            pass
+
+        # Something in the batch doesn't fit the schema, so find the offending rows and set them aside
+        valid_rows = []
+        for row in rows:
             try:
-                # Wait 60 seconds for the publish call to succeed.
-                logger.info(publish_future.result(timeout=60))
-            except futures.TimeoutError:
-                logger.info(f"Publishing {data} timed out.")
+                pa.Table.from_pylist([row], schema=self.schema)
+            except (pa.ArrowException, TypeError, ValueError) as e:
+                self._reject(row, e)
+            else:
+                valid_rows.append(row)
+        return valid_rows, pa.Table.from_pylist(valid_rows, schema=self.schema)
+
+    def _reject(self, row: Dict[str, Any], error: Exception):
+        rejected_path = os.path.join(self.directory, f"rejected-{self.run_id}.ndjson")
+        logger.warning(f"{self.item_type} doesn't match the parquet schema, moving it to {rejected_path}: {error}")
+        with open(rejected_path, "a", encoding="utf-8") as rejected_file:
+            rejected_file.write(json.dumps(row, default=str) + "\n")
+
+    def close(self):
+        if self.opened_at is None:
+            return
+        if self.ndjson_file:
+            self.ndjson_file.close()
+            self.ndjson_file = None
+        if self.parquet_writer:
+            self.parquet_writer.close()
+            self.parquet_writer = None
+        for path in self.in_progress_paths:
+            os.rename(path, path.removesuffix(".inprogress"))
+        logger.info(f"Rotated {self.item_type} output after {self.bytes_written} bytes")
+        self.in_progress_paths = []
+        self.opened_at = None
+        self.bytes_written = 0
+
+    def _open(self):
+        self.file_count += 1
+        base_name = os.path.join(self.directory, f"part-{int(time.time())}-{self.run_id}-{self.file_count:05d}")
+        if self.write_ndjson:
+            path = f"{base_name}.ndjson.gz.inprogress"
+            self.ndjson_file = gzip.open(path, "wt", encoding="utf-8")
+            self.in_progress_paths.append(path)
+        if self.write_parquet:
+            path = f"{base_name}.parquet.inprogress"
+            self.parquet_writer = pq.ParquetWriter(path, self.schema, compression="snappy")
+            self.in_progress_paths.append(path)
+        self.opened_at = time.monotonic()
+
+    def _should_rotate(self) -> bool:
+        if self.opened_at is None:
+            return False
+        return self.bytes_written >= self.max_bytes or time.monotonic() - self.opened_at >= self.max_seconds
+
+
+class FileSinkPipeline(object):
+    """
+    Streams items to rolling local files instead of PubSub, which is a lot cheaper for bulk backfills since the files
+    can be bulk loaded in one go. Output is partitioned per item type, e.g. `<output_dir>/BookItem/part-*.parquet`
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.output_dir = None
+        # Keeps file names unique when several crawls write to the same output_dir at the same time
+        self.run_id = uuid.uuid4().hex[:12]
+        self.formats = settings.getlist("FILE_SINK_FORMATS")
+        self.buffer_size = settings.getint("FILE_SINK_BUFFER_SIZE")
+        self.max_bytes = settings.getint("FILE_SINK_MAX_BYTES")
+        self.max_seconds = settings.getint("FILE_SINK_MAX_SECONDS")
+        self.partitions: Dict[str, RollingPartition] = {}
+        # Partitions are only rotated by age when an item arrives, so one which stops getting items needs a timer
+        self.rotation_check = task.LoopingCall(self._rotate_stale_partitions)
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        # Finish up once every pipeline has closed, see ReviewAggregationPipeline.close_spider
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    def spider_opened(self, spider):
+        self.output_dir = getattr(spider, "output_dir", None)
+        if not self.output_dir:
+            logger.debug("output_dir is not set, skipping the FileSinkPipeline.")
+            return
+        self.rotation_check.start(min(self.max_seconds, ROTATION_CHECK_SECONDS), now=False)
+
+    def process_item(self, item, spider):
+        if not self.output_dir:
+            return item
+
+        item_type = type(item).__name__
+        partition = self.partitions.get(item_type)
+        if partition is None:
+            partition = RollingPartition(self.output_dir, item_type, self.run_id, self.formats, self.buffer_size,
+                                         self.max_bytes, self.max_seconds)
+            self.partitions[item_type] = partition
+
+        partition.add(ItemAdapter(item).asdict())
+        return item
+
+    def spider_closed(self, spider):
+        if self.rotation_check.running:
+            self.rotation_check.stop()
+        for partition in self.partitions.values():
+            partition.flush()
+            partition.close()
+
+    def _rotate_stale_partitions(self):
+        for partition in self.partitions.values():
+            partition.rotate_if_stale()
+
+
+class ReviewColumns(object):
+    """
+    Columnar buffer of every review seen during the crawl. Book and user IDs are interned to integer indexes, so each
+    review only costs a few bytes of NumPy array instead of a whole UserReviewItem. A rating or read year of 0 means
+    it was missing.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.book_idx = np.empty(INITIAL_REVIEW_CAPACITY, dtype=np.int32)
+        self.user_idx = np.empty(INITIAL_REVIEW_CAPACITY, dtype=np.int32)
+        self.rating = np.empty(INITIAL_REVIEW_CAPACITY, dtype=np.int8)
+        self.read_year = np.empty(INITIAL_REVIEW_CAPACITY, dtype=np.int16)
+        self.book_ids: List[str] = []
+        self.user_ids: List[str] = []
+        self._book_lookup: Dict[str, int] = {}
+        self._user_lookup: Dict[str, int] = {}
+
+    def append(self, book_id: str, user_id: str, rating: int, read_year: int):
+        if self.size == len(self.rating):
+            self._grow()
+        self.book_idx[self.size] = self._intern(book_id, self._book_lookup, self.book_ids)
+        self.user_idx[self.size] = self._intern(user_id, self._user_lookup, self.user_ids)
+        self.rating[self.size] = rating
+        self.read_year[self.size] = read_year
+        self.size += 1
+
+    def _grow(self):
+        new_capacity = len(self.rating) * 2
+        for column in ("book_idx", "user_idx", "rating", "read_year"):
+            old = getattr(self, column)
+            new = np.empty(new_capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, column, new)
+
+    @staticmethod
+    def _intern(id_value: str, lookup: Dict[str, int], ids: List[str]) -> int:
+        idx = lookup.get(id_value)
+        if idx is None:
+            idx = len(ids)
+            lookup[id_value] = idx
+            ids.append(id_value)
+        return idx
+
+
+def rollup_reviews(key_idx: np.ndarray, keys: List[str], rating: np.ndarray, read_year: np.ndarray) -> List[Dict]:
+    """
+    Computes the review count, mean rating, rating histogram and read year histogram for every key in one go
+
+    :param key_idx: Index into keys for every review
+    :param keys: The book or user IDs being grouped by
+    :param rating: Rating for every review, 1 to 5, or 0 if it was missing
+    :param read_year: Year every review's book was read, or 0 if it was missing
+    :return: One dictionary per key
+    """
+    key_count = len(keys)
+    num_reviews = np.bincount(key_idx, minlength=key_count)
+
+    rated = (rating >= 1) & (rating <= 5)
+    rated_idx = key_idx[rated]
+    rated_values = rating[rated].astype(np.int64)
+    rating_histogram = np.bincount(rated_idx * 5 + rated_values - 1, minlength=key_count * 5).reshape(key_count, 5)
+    rating_sum = np.bincount(rated_idx, weights=rated_values, minlength=key_count)
+    num_rated = rating_histogram.sum(axis=1)
+
+    # A dense key x year matrix would get huge on big crawls, so count the (key, year) pairs which actually occur
+    years, year_idx = np.unique(read_year, return_inverse=True)
+    pairs, pair_counts = np.unique(key_idx.astype(np.int64) * len(years) + year_idx, return_counts=True)
+    pair_keys = pairs // len(years)
+    pair_years = years[pairs % len(years)]
+    pair_bounds = np.searchsorted(pair_keys, np.arange(key_count + 1))
+
+    rollups = []
+    for idx in np.flatnonzero(num_reviews):
+        read_year_histogram = {}
+        for year, count in zip(pair_years[pair_bounds[idx]:pair_bounds[idx + 1]],
+                               pair_counts[pair_bounds[idx]:pair_bounds[idx + 1]]):
+            read_year_histogram[str(year) if year else UNKNOWN_READ_YEAR] = int(count)
+        rollups.append({
+            "id": keys[idx],
+            "num_reviews": int(num_reviews[idx]),
+            "avg_rating": float(rating_sum[idx] / num_rated[idx]) if num_rated[idx] else None,
+            "rating_histogram": rating_histogram[idx].tolist(),
+            "read_year_histogram": read_year_histogram,
+        })
+    return rollups
+
+
+class ReviewAggregationPipeline(object):
+    """
+    Instead of publishing every UserReviewItem, collects them into ReviewColumns and emits per book and per user
+    aggregates once the crawl is done. The raw reviews are dropped unless keep_raw_reviews is passed to the spider.
+    The aggregates are emitted when the spider goes idle, or when it closes if it never got there.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.enabled = False
+        self.keep_raw_reviews = False
+        self.columns = ReviewColumns()
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_idle, signal=signals.spider_idle)
+
+    def spider_opened(self, spider):
+        self.enabled = getattr(spider, "aggregate", False)
+        self.keep_raw_reviews = getattr(spider, "keep_raw_reviews", False)
+
+    def process_item(self, item, spider):
+        if not self.enabled or not isinstance(item, UserReviewItem):
+            return item
+
+        user_rating = item.get("user_rating")
+        date_read = item.get("date_read")
+        # Dates come out of safe_parse_date as ISO strings, and missing years are defaulted to year 1
+        read_year = int(date_read[:4]) if date_read else 0
+        self.columns.append(item.get("book_id"), item.get("user_id"), int(user_rating) if user_rating else 0,
+                            read_year if read_year > 1 else 0)
+        self.crawler.stats.inc_value("review_aggregation/reviews")
+
+        if self.keep_raw_reviews:
+            return item
+        raise AggregatedReview("Review was aggregated")
+
+    def spider_idle(self, spider):
+        if not self.enabled or self.columns.size == 0:
+            return
+
+        columns, self.columns = self.columns, ReviewColumns()
+        # Pipelines can't emit items of their own, so hand the aggregates back to the spider through a dummy request
+        # and let them go through the rest of the pipelines like any other item
+        self.crawler.engine.crawl(Request("data:,", callback=self._emit_aggregates, cb_kwargs={"columns": columns},
+                                          dont_filter=True))
+        raise DontCloseSpider
+
+    def close_spider(self, spider):
+        if not self.enabled or self.columns.size == 0:
+            return
+
+        # The crawl closed without going idle, e.g. because of a CLOSESPIDER_* limit or a shutdown, so the engine won't
+        # take new requests anymore. Push the aggregates straight through the item pipelines instead. The sinks only
+        # finish up on spider_closed, which is sent after every pipeline's close_spider, so they still get written
+        logger.warning(f"Crawl closed before {self.columns.size} reviews were aggregated, writing the aggregates now")
+        columns, self.columns = self.columns, ReviewColumns()
+        item_pipelines = self.crawler.engine.scraper.itemproc
+        for item in self._iter_aggregates(columns):
+            item_pipelines.process_item(item, spider).addErrback(
+                lambda failure: logger.error(f"Failed to write out a review aggregate: {failure.getErrorMessage()}"))
+
+    def _emit_aggregates(self, response, columns: ReviewColumns):
+        return self._iter_aggregates(columns)
+
+    def _iter_aggregates(self, columns: ReviewColumns):
+        rating = columns.rating[:columns.size]
+        read_year = columns.read_year[:columns.size]
+
+        for rollup in rollup_reviews(columns.book_idx[:columns.size], columns.book_ids, rating, read_year):
+            book_id = rollup.pop("id")
+            self.crawler.stats.inc_value("review_aggregation/book_aggregates")
+            yield BookReviewAggregateItem(book_id=book_id, **rollup)
 
-        return callback
+        for rollup in rollup_reviews(columns.user_idx[:columns.size], columns.user_ids, rating, read_year):
+            user_id = rollup.pop("id")
+            self.crawler.stats.inc_value("review_aggregation/user_aggregates")
+            yield UserReviewAggregateItem(user_id=user_id, **rollup)
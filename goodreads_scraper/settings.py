@@ -7,6 +7,8 @@
 #     https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 #     https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import os
+
 BOT_NAME = "goodreads_scraper"
 
 SPIDER_MODULES = ["goodreads_scraper.spiders"]
@@ -50,9 +52,18 @@ DOWNLOAD_DELAY = 1
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#    "goodreads_scraper.middlewares.GoodreadsScraperDownloaderMiddleware": 543,
-# }
+DOWNLOADER_MIDDLEWARES = {
+    "goodreads_scraper.middlewares.DownloadStatsMiddleware": 950,
+}
+
+# Same handlers as Scrapy's default HTTP/1.1 and HTTP/2 ones, but record new connections and their setup time in the
+# stats. Set GOODREADS_HTTP2=1 to fetch https pages over HTTP/2 instead
+DOWNLOAD_HANDLERS = {
+    "http": "goodreads_scraper.handlers.StatsHTTP11DownloadHandler",
+    "https": "goodreads_scraper.handlers.StatsHTTP11DownloadHandler",
+}
+if os.environ.get("GOODREADS_HTTP2") == "1":
+    DOWNLOAD_HANDLERS["https"] = "goodreads_scraper.handlers.StatsH2DownloadHandler"
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
@@ -66,6 +77,24 @@ DOWNLOAD_DELAY = 1
 #    "goodreads_scraper.pipelines.GoodreadsScraperPipeline": 300,
 # }
 
+LOG_FORMATTER = "goodreads_scraper.logformatter.GoodreadsLogFormatter"
+
+# Rolling file output used by FileSinkPipeline when a spider is given an output_dir crawl argument. Sizes are counted
+# before compression, and files are rotated on whichever of the two limits is hit first
+FILE_SINK_FORMATS = ["ndjson", "parquet"]
+FILE_SINK_BUFFER_SIZE = 5000
+FILE_SINK_MAX_BYTES = 256 * 1024 * 1024
+FILE_SINK_MAX_SECONDS = 15 * 60
+
+# Every PubsubPipeline batch is written to a spool on disk first and published from a background thread. Whatever
+# hasn't been published PUBSUB_SPOOL_CLOSE_TIMEOUT seconds after the spider closes is replayed on the next start
+PUBSUB_SPOOL_DIR = ".pubsub_spool"
+PUBSUB_SPOOL_SEGMENT_BYTES = 64 * 1024 * 1024
+PUBSUB_SPOOL_CLOSE_TIMEOUT = 5 * 60
+PUBSUB_PUBLISH_TIMEOUT = 60
+# How many spooled batches can be waiting on Pub/Sub at once
+PUBSUB_MAX_PUBLISHES_IN_FLIGHT = 20
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 # AUTOTHROTTLE_ENABLED = True
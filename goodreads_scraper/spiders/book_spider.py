@@ -8,48 +8,28 @@ import isbnlib
 import scrapy
 from scrapy import Request
 
-from ..items import BookLoader, BookItem
+from ..id_sources import FIFO_SCHEDULER_SETTINGS, IdSourceMixin, check_id_source
+from ..items import BookLoader, BookItem, BookStatsItem, convert_epoch_to_timestamp
 
 TYPENAME = "__typename"
+# Fields which are always parsed, no matter which fields were requested
+BOOK_KEY_FIELDS = frozenset(["book_id", "scrape_time"])
+BOOK_STATS_FIELDS = frozenset(BookStatsItem.fields)
+WORK_FIELDS = ("work_internal_id", "work_id", "original_title", "publish_date", "num_ratings", "num_reviews",
+               "avg_rating", "rating_histogram")
 
 
-class BookSpider(scrapy.Spider):
-    """Extract information from a /book/show type page on Goodreads"""
-    name = "book"
-    custom_settings = {'ITEM_PIPELINES': {'goodreads_scraper.pipelines.PubsubPipeline': 400}}
+class BookParserMixin(object):
+    """Parses a /book/show page into a BookItem, shared by every spider which crawls book pages"""
 
-    def __init__(self, books: str, project_id: str = None, topic_name: str = None, *args, **kwargs):
-        """
-        :param books: comma delimited list of goodreads book IDs
-        :param project_id: (Optional) GCP project ID
-        :param topic_name: (Optional) GCP Pub/Sub topic name
-        """
-        super().__init__(*args, **kwargs)
-        if project_id and topic_name:
-            self.custom_settings["GCP_PROJECT_ID"] = project_id
-            self.custom_settings["PUBSUB_TOPIC_NAME"] = topic_name
-        self.start_urls = books.split(',')
-
-    def start_requests(self):
-        for book_id in self.start_urls:
-            converted_url = self._generate_book_url(book_id)
-            yield Request(converted_url, callback=self.parse, dont_filter=True,
-                          meta={"retry_count": 0, "book_id": book_id})
-
-    def parse(self, response):
-        return self.parse_book(response)
+    # Book fields to parse, or None for all of them. See BookSpider's fields crawl arg
+    fields = None
 
     def parse_book(self, response, loader=None):
-        if not loader:
-            loader = BookLoader(BookItem(), response=response)
-
         text_body = response.xpath('//*[@id="__NEXT_DATA__"]/text()').get()
         parsed_json_body = json.loads(text_body)
         book_info = parsed_json_body['props']['pageProps']['apolloState']
 
-        contributor = self._take_largest_element(book_info, "Contributor")
-        series = self._take_first_element(book_info, "Series")
-        work = self._take_largest_element(book_info, "Work")
         book = self._take_largest_element(book_info, "Book")
 
         if not book:
@@ -57,75 +37,122 @@ class BookSpider(scrapy.Spider):
             book_id = response.meta.get("book_id")
             if retry_count < 10:
                 converted_url = self._generate_book_url(book_id)
-                return Request(converted_url, callback=self.parse, dont_filter=True,
+                return Request(converted_url, callback=self.parse_book, dont_filter=True,
                                meta={"retry_count": retry_count + 1, "book_id": book_id})
             else:
                 self.logger.warning("We've tried 10 times... let's call it a day")
                 return
 
-        book_details = book.get("details")
+        # The stats refresh is by far our most common job, so skip the loader entirely for it
+        if self.fields is not None and self.fields <= BOOK_STATS_FIELDS:
+            return self._parse_book_stats(book, self._take_largest_element(book_info, "Work"))
+
+        if not loader:
+            loader = BookLoader(BookItem(), response=response)
+
+        # Only look up the apollo blocks the requested fields actually need
+        contributor = None
+        if self._wants("author", "author_url"):
+            contributor = self._take_largest_element(book_info, "Contributor")
+        series = None
+        if self._wants("series"):
+            series = self._take_first_element(book_info, "Series")
+        work = None
+        if self._wants(*WORK_FIELDS):
+            work = self._take_largest_element(book_info, "Work")
 
-        backup_isbns = self._extract_isbn_from_affiliates(
-            book.get("links({})", {}).get("secondaryAffiliateLinks", list()))
+        book_details = book.get("details")
 
         # High Level Info
-        loader.add_value('book_id', book.get("legacyId"))
-        loader.add_value('book_url', book.get("webUrl"))
-        loader.add_value('book_title', book.get("title"))
-        loader.add_value('image_url', book.get("imageUrl"))
-        loader.add_value('author', contributor.get("name"))
-        loader.add_value('author_url', contributor.get("webUrl"))
-        loader.add_value('book_description', book.get('description({"stripped":true})'))
-        loader.add_value('scrape_time', round(time.time() * 1000))
-
-        # Work Details
-        loader.add_value('work_internal_id', work.get("id"))
-        loader.add_value('work_id', work.get("legacyId"))
-        loader.add_value('original_title', work.get("details").get("originalTitle"))
-
-        # Prioritize main work publication date over edition publication date
-        work_publication_date = work.get("details").get("publicationTime")
-        publication_time = work_publication_date if work_publication_date else book.get("details").get(
-            "publicationTime")
-        if not publication_time:
-            publication_time = 1610696566000
-        elif publication_time < -62003553200000:
-            publication_time = -62003553200000
-
-        loader.add_value('publish_date', publication_time)
-
-        # Work Statistics
-        loader.add_value('num_ratings', work.get("stats").get("ratingsCount"))
-        loader.add_value('num_reviews', work.get("stats").get("textReviewsCount"))
-        loader.add_value('avg_rating', work.get("stats").get("averageRating"))
-        loader.add_value('rating_histogram', work.get("stats").get("ratingsCountDist"))
+        self._add_value(loader, 'book_id', book.get("legacyId"))
+        self._add_value(loader, 'book_url', book.get("webUrl"))
+        self._add_value(loader, 'book_title', book.get("title"))
+        self._add_value(loader, 'image_url', book.get("imageUrl"))
+        if contributor:
+            self._add_value(loader, 'author', contributor.get("name"))
+            self._add_value(loader, 'author_url', contributor.get("webUrl"))
+        self._add_value(loader, 'book_description', book.get('description({"stripped":true})'))
+        self._add_value(loader, 'scrape_time', round(time.time() * 1000))
+
+        if work:
+            # Work Details
+            self._add_value(loader, 'work_internal_id', work.get("id"))
+            self._add_value(loader, 'work_id', work.get("legacyId"))
+            self._add_value(loader, 'original_title', work.get("details").get("originalTitle"))
+
+            # Prioritize main work publication date over edition publication date
+            work_publication_date = work.get("details").get("publicationTime")
+            publication_time = work_publication_date if work_publication_date else book.get("details").get(
+                "publicationTime")
+            if not publication_time:
+                publication_time = 1610696566000
+            elif publication_time < -62003553200000:
+                publication_time = -62003553200000
+
+            self._add_value(loader, 'publish_date', publication_time)
+
+            # Work Statistics
+            self._add_value(loader, 'num_ratings', work.get("stats").get("ratingsCount"))
+            self._add_value(loader, 'num_reviews', work.get("stats").get("textReviewsCount"))
+            self._add_value(loader, 'avg_rating', work.get("stats").get("averageRating"))
+            self._add_value(loader, 'rating_histogram', work.get("stats").get("ratingsCountDist"))
 
         # Book Statistics
-        loader.add_value('num_pages', book_details.get("numPages"))
-        loader.add_value('language', book_details.get("language").get("name"))
-        loader.add_value('asin', book_details.get("asin"))
-        loader.add_value('series', series.get("title") if series else "")
-        loader.add_value('genres', self._parse_genres(book.get("bookGenres")))
+        self._add_value(loader, 'num_pages', book_details.get("numPages"))
+        self._add_value(loader, 'language', book_details.get("language").get("name"))
+        self._add_value(loader, 'asin', book_details.get("asin"))
+        if self._wants("series"):
+            self._add_value(loader, 'series', series.get("title") if series else "")
+        if self._wants("genres"):
+            self._add_value(loader, 'genres', self._parse_genres(book.get("bookGenres")))
 
         # ISBN requires a bit of wrangling
-        isbn = book_details.get("isbn") if book_details.get("isbn") else backup_isbns.get("isbn")
-        isbn13 = book_details.get("isbn13") if book_details.get("isbn13") else backup_isbns.get("isbn13")
-        loader.add_value('isbn', isbn)
-        loader.add_value('isbn13', isbn13)
+        if self._wants("isbn", "isbn13"):
+            backup_isbns = self._extract_isbn_from_affiliates(
+                book.get("links({})", {}).get("secondaryAffiliateLinks", list()))
+            isbn = book_details.get("isbn") if book_details.get("isbn") else backup_isbns.get("isbn")
+            isbn13 = book_details.get("isbn13") if book_details.get("isbn13") else backup_isbns.get("isbn13")
+            self._add_value(loader, 'isbn', isbn)
+            self._add_value(loader, 'isbn13', isbn13)
 
         return loader.load_item()
 
+    def _parse_book_stats(self, book, work):
+        work_stats = work.get("stats", {}) if work else {}
+        rating_histogram = work_stats.get("ratingsCountDist")
+        stats = {
+            "book_id": book.get("legacyId"),
+            "scrape_time": convert_epoch_to_timestamp(round(time.time() * 1000)),
+            "num_ratings": work_stats.get("ratingsCount"),
+            "num_reviews": work_stats.get("textReviewsCount"),
+            "avg_rating": work_stats.get("averageRating"),
+            "rating_histogram": list(rating_histogram) if rating_histogram is not None else None,
+        }
+        # Leave missing values out, just like the BookLoader would
+        return BookStatsItem({field_name: value for field_name, value in stats.items()
+                              if field_name in self.fields and value is not None})
+
+    def _wants(self, *field_names):
+        return self.fields is None or any(field_name in self.fields for field_name in field_names)
+
+    def _add_value(self, loader, field_name, value):
+        if self._wants(field_name):
+            loader.add_value(field_name, value)
+
     def _take_largest_element(self, input_dict, element_type):
         largest = None
+        largest_count = None
         for block in input_dict.values():
             if block.get(TYPENAME, "") == element_type:
                 if largest is None:
                     largest = block
                 else:
                     key_count = self._count_keys_recursive(block)
-                    largest_count = self._count_keys_recursive(largest)
+                    if largest_count is None:
+                        largest_count = self._count_keys_recursive(largest)
                     if key_count > largest_count:
                         largest = block
+                        largest_count = key_count
             else:
                 continue
         return largest
@@ -207,3 +234,51 @@ class BookSpider(scrapy.Spider):
                 break
 
         return isbn_dict
+
+
+class BookSpider(BookParserMixin, IdSourceMixin, scrapy.Spider):
+    """Extract information from a /book/show type page on Goodreads"""
+    name = "book"
+    id_key = "book_id"
+    custom_settings = {'ITEM_PIPELINES': {'goodreads_scraper.pipelines.PubsubPipeline': 400,
+                                         'goodreads_scraper.pipelines.FileSinkPipeline': 500},
+                       **FIFO_SCHEDULER_SETTINGS}
+
+    def __init__(self, books: str = None, project_id: str = None, topic_name: str = None, output_dir: str = None,
+                 id_source: str = None, fields: str = None, *args, **kwargs):
+        """
+        :param books: comma delimited list of goodreads book IDs
+        :param project_id: (Optional) GCP project ID
+        :param topic_name: (Optional) GCP Pub/Sub topic name
+        :param output_dir: (Optional) Directory to stream rolling NDJSON/Parquet files to instead of Pub/Sub
+        :param id_source: (Optional) File path or range to lazily read book IDs from instead of books, see iter_ids
+        :param fields: (Optional) comma delimited list of BookItem fields to parse, book_id and scrape_time are always
+                       included. If they are all stats fields, a slimmer BookStatsItem is emitted instead
+        """
+        super().__init__(*args, **kwargs)
+        if project_id and topic_name:
+            self.custom_settings["GCP_PROJECT_ID"] = project_id
+            self.custom_settings["PUBSUB_TOPIC_NAME"] = topic_name
+        # Kept on the instance, custom_settings is shared by every crawl of this spider in the same process
+        self.output_dir = output_dir
+        if not books and not id_source:
+            raise ValueError("Either books or id_source must be set")
+        if id_source:
+            check_id_source(id_source)
+        self.start_urls = books.split(',') if books else []
+        self.id_source = id_source
+        if fields:
+            requested_fields = frozenset(field.strip() for field in fields.split(","))
+            unknown_fields = requested_fields - frozenset(BookItem.fields)
+            if unknown_fields:
+                raise ValueError(f"Unknown book fields: {', '.join(sorted(unknown_fields))}")
+            self.fields = requested_fields | BOOK_KEY_FIELDS
+
+    def start_requests(self):
+        for book_id in self.iter_start_ids():
+            converted_url = self._generate_book_url(book_id)
+            yield Request(converted_url, callback=self.parse, dont_filter=True,
+                          meta={"retry_count": 0, "book_id": book_id})
+
+    def parse(self, response):
+        return self.parse_book(response)
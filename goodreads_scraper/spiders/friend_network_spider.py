@@ -19,18 +19,23 @@ GOODREADS_URL_PREFIX = "https://www.goodreads.com"
 class FriendNetworkSpider(scrapy.Spider):
     name = "friend_network"
     custom_settings = {'CLOSESPIDER_ITEMCOUNT': 15000,
-                       'ITEM_PIPELINES': {'goodreads_scraper.pipelines.PubsubPipeline': 400}}
+                       'ITEM_PIPELINES': {'goodreads_scraper.pipelines.PubsubPipeline': 400,
+                                          'goodreads_scraper.pipelines.FileSinkPipeline': 500}}
 
-    def __init__(self, start_profile_id: str, project_id: str = None, topic_name: str = None, *args, **kwargs):
+    def __init__(self, start_profile_id: str, project_id: str = None, topic_name: str = None, output_dir: str = None,
+                 *args, **kwargs):
         """
         :param books: comma delimited list of goodreads book IDs
         :param project_id: (Optional) GCP project ID
         :param topic_name: (Optional) GCP Pub/Sub topic name
+        :param output_dir: (Optional) Directory to stream rolling NDJSON/Parquet files to instead of Pub/Sub
         """
         super().__init__(*args, **kwargs)
         if project_id and topic_name:
             self.custom_settings["GCP_PROJECT_ID"] = project_id
             self.custom_settings["PUBSUB_TOPIC_NAME"] = topic_name
+        # Kept on the instance, custom_settings is shared by every crawl of this spider in the same process
+        self.output_dir = output_dir
         self.profile_id = start_profile_id
 
     def start_requests(self):
@@ -0,0 +1,78 @@
+"""Spider which crawls user reviews and then every book those users have read, all in one pass"""
+import logging
+from collections import deque
+
+from scrapy import Request, signals
+from scrapy.exceptions import DontCloseSpider
+
+from .book_spider import BookParserMixin
+from .user_reviews_spider import UserReviewsSpider
+from ..id_sources import FIFO_SCHEDULER_SETTINGS
+from ..items import UserReviewItem
+
+logger = logging.getLogger(__name__)
+DEFAULT_BOOK_FETCH_RATIO = 5
+
+
+class UserBooksSpider(BookParserMixin, UserReviewsSpider):
+    """
+    Works just like the user_reviews spider, but every book ID found in a review is also crawled like the book spider
+    would, without having to round trip the IDs through another service. Book IDs are deduplicated in memory, so each
+    book is only fetched once per crawl no matter how many users have read it.
+    """
+    name = "user_books"
+    custom_settings = {'ITEM_PIPELINES': {'goodreads_scraper.pipelines.ReviewAggregationPipeline': 300,
+                                         'goodreads_scraper.pipelines.PubsubPipeline': 400,
+                                         'goodreads_scraper.pipelines.FileSinkPipeline': 500},
+                       **FIFO_SCHEDULER_SETTINGS}
+
+    def __init__(self, profiles=None, project_id=None, topic_name=None, output_dir=None, id_source=None,
+                 aggregate=None, keep_raw_reviews=None, book_fetch_ratio=DEFAULT_BOOK_FETCH_RATIO, *args, **kwargs):
+        """
+        :param profiles: comma delimited list of goodreads profile IDs
+        :param project_id: (Optional) GCP project ID
+        :param topic_name: (Optional) GCP Pub/Sub topic name
+        :param output_dir: (Optional) Directory to stream rolling NDJSON/Parquet files to instead of Pub/Sub
+        :param id_source: (Optional) File path or range to lazily read profile IDs from instead of profiles
+        :param aggregate: (Optional) "true" to emit per book and per user review aggregates instead of raw reviews
+        :param keep_raw_reviews: (Optional) "true" to still emit the raw reviews alongside the aggregates
+        :param book_fetch_ratio: (Optional) How many book pages to fetch for every review page fetched. Whatever is
+                                 left over once the reviews are done gets fetched at the end
+        """
+        super().__init__(profiles, project_id, topic_name, output_dir, id_source, aggregate, keep_raw_reviews, *args,
+                         **kwargs)
+        self.book_fetch_ratio = int(book_fetch_ratio)
+        self.seen_book_ids = set()
+        self.pending_book_ids = deque()
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
+
+    def parse(self, response):
+        for result in super().parse(response):
+            if isinstance(result, UserReviewItem):
+                book_id = result.get("book_id")
+                if book_id and book_id not in self.seen_book_ids:
+                    self.seen_book_ids.add(book_id)
+                    self.pending_book_ids.append(book_id)
+            yield result
+
+        yield from self._next_book_requests(self.book_fetch_ratio)
+
+    def spider_idle(self, spider):
+        # Review pages are done, so drain the rest of the book IDs a downloader's worth at a time
+        if not self.pending_book_ids:
+            return
+        for request in self._next_book_requests(self.settings.getint("CONCURRENT_REQUESTS")):
+            self.crawler.engine.crawl(request)
+        raise DontCloseSpider
+
+    def _next_book_requests(self, count):
+        while self.pending_book_ids and count > 0:
+            book_id = self.pending_book_ids.popleft()
+            count -= 1
+            yield Request(self._generate_book_url(book_id), callback=self.parse_book, dont_filter=True,
+                          meta={"retry_count": 0, "book_id": book_id})
@@ -6,6 +6,7 @@ import time
 import scrapy
 from scrapy import Request
 
+from ..id_sources import FIFO_SCHEDULER_SETTINGS, IdSourceMixin, check_id_source
 from ..items import UserReviewLoader, UserReviewItem
 
 logger = logging.getLogger(__name__)
@@ -15,24 +16,46 @@ ITEMS_PER_PAGE = 200
 MAX_PAGE_COUNT = 60
 
 
-class UserReviewsSpider(scrapy.Spider):
+def is_true(crawl_arg):
+    return str(crawl_arg).lower() in ("true", "1", "yes")
+
+
+class UserReviewsSpider(IdSourceMixin, scrapy.Spider):
     name = "user_reviews"
-    custom_settings = {'ITEM_PIPELINES': {'goodreads_scraper.pipelines.PubsubPipeline': 400}}
+    id_key = "user_id"
+    custom_settings = {'ITEM_PIPELINES': {'goodreads_scraper.pipelines.ReviewAggregationPipeline': 300,
+                                         'goodreads_scraper.pipelines.PubsubPipeline': 400,
+                                         'goodreads_scraper.pipelines.FileSinkPipeline': 500},
+                       **FIFO_SCHEDULER_SETTINGS}
 
-    def __init__(self, profiles, project_id=None, topic_name=None, *args, **kwargs):
+    def __init__(self, profiles=None, project_id=None, topic_name=None, output_dir=None, id_source=None,
+                 aggregate=None, keep_raw_reviews=None, *args, **kwargs):
         """
         :param profiles: comma delimited list of goodreads profile IDs
         :param project_id: (Optional) GCP project ID
         :param topic_name: (Optional) GCP Pub/Sub topic name
+        :param output_dir: (Optional) Directory to stream rolling NDJSON/Parquet files to instead of Pub/Sub
+        :param id_source: (Optional) File path or range to lazily read profile IDs from instead of profiles
+        :param aggregate: (Optional) "true" to emit per book and per user review aggregates instead of raw reviews
+        :param keep_raw_reviews: (Optional) "true" to still emit the raw reviews alongside the aggregates
         """
         super().__init__(*args, **kwargs)
         if project_id and topic_name:
             self.custom_settings["GCP_PROJECT_ID"] = project_id
             self.custom_settings["PUBSUB_TOPIC_NAME"] = topic_name
-        self.start_urls = profiles.split(",")
+        # Kept on the instance, custom_settings is shared by every crawl of this spider in the same process
+        self.output_dir = output_dir
+        self.aggregate = is_true(aggregate)
+        self.keep_raw_reviews = is_true(keep_raw_reviews)
+        if not profiles and not id_source:
+            raise ValueError("Either profiles or id_source must be set")
+        if id_source:
+            check_id_source(id_source)
+        self.start_urls = profiles.split(",") if profiles else []
+        self.id_source = id_source
 
     def start_requests(self):
-        for user_id in self.start_urls:
+        for user_id in self.iter_start_ids():
             converted_url = self.format_review_url(user_id, 1)
             yield Request(converted_url, callback=self.parse, dont_filter=True, meta={"user_id": user_id, "page": 1})
 
@@ -0,0 +1,303 @@
+"""Disk backed spool which sits between the PubsubPipeline and Pub/Sub, so the crawl never waits on publish latency"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+from google.api_core.exceptions import InvalidArgument
+from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.publisher.exceptions import MessageTooLargeError
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+CURSOR_FILE_NAME = "cursor"
+DEAD_LETTER_FILE_NAME = "dead-letter.ndjson"
+MAX_RETRY_BACKOFF_SECONDS = 60
+# Pub/Sub will never accept these batches no matter how often they are retried
+NON_RETRYABLE_ERRORS = (InvalidArgument, MessageTooLargeError)
+
+# ScrapyRT runs every crawl in the same process, so two crawls publishing to the same topic have to share one spool
+# rather than both appending to the same segment files
+_spools: Dict[str, "PubsubSpool"] = {}
+_spools_lock = threading.Lock()
+
+
+class SegmentedLog(object):
+    """
+    Append-only log of newline delimited records, split over numbered segment files. Reading and committing are
+    separate, so several records can be read ahead before the first one has been committed. The cursor file stores the
+    committed position, and segments are deleted once the committed position has moved past them. Every time the log
+    is opened a new segment is started, so anything left over from a previous run gets read before the new records.
+    """
+
+    def __init__(self, directory: str, max_segment_bytes: int):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.condition = threading.Condition()
+        os.makedirs(directory, exist_ok=True)
+
+        existing_segments = self._list_segments()
+        self.write_segment = existing_segments[-1] + 1 if existing_segments else 0
+        self.write_file = open(self._segment_path(self.write_segment), "ab")
+
+        self.commit_segment, self.commit_offset = self._load_cursor(existing_segments)
+        self.read_segment, self.read_offset = self.commit_segment, self.commit_offset
+        self.read_file = None
+
+    def append(self, record: bytes):
+        with self.condition:
+            self.write_file.write(record + b"\n")
+            self.write_file.flush()
+            os.fsync(self.write_file.fileno())
+            if self.write_file.tell() >= self.max_segment_bytes:
+                self.write_file.close()
+                self.write_segment += 1
+                self.write_file = open(self._segment_path(self.write_segment), "ab")
+            self.condition.notify_all()
+
+    def read_next(self) -> Optional[Tuple[bytes, int, int]]:
+        """
+        :return: The next unread record, along with the segment and offset to commit once it has been handled, or
+                 None if the reader has caught up with the writer
+        """
+        with self.condition:
+            while True:
+                if self.read_file is None:
+                    self.read_file = open(self._segment_path(self.read_segment), "rb")
+                self.read_file.seek(self.read_offset)
+                line = self.read_file.readline()
+
+                if line.endswith(b"\n"):
+                    self.read_offset = self.read_file.tell()
+                    return line[:-1], self.read_segment, self.read_offset
+                if self.read_segment == self.write_segment:
+                    return None
+
+                # Older segments are never appended to again, so a record without a newline is a torn write from a
+                # crash, and there is nothing after it
+                if line:
+                    logger.warning(f"Skipping truncated record at the end of spool segment {self.read_segment}")
+                self.read_file.close()
+                self.read_file = None
+                self.read_segment += 1
+                self.read_offset = 0
+
+    def commit(self, segment: int, offset: int):
+        """Marks everything up to offset in segment as handled, records must be committed in the order they were read"""
+        with self.condition:
+            for finished_segment in range(self.commit_segment, segment):
+                os.remove(self._segment_path(finished_segment))
+            self.commit_segment = segment
+            self.commit_offset = offset
+            self._save_cursor()
+
+    def rewind(self):
+        """Moves the read position back to the committed position, so everything read but not committed is read again"""
+        with self.condition:
+            if self.read_file:
+                self.read_file.close()
+                self.read_file = None
+            self.read_segment, self.read_offset = self.commit_segment, self.commit_offset
+
+    def wait(self, timeout: float):
+        with self.condition:
+            self.condition.wait(timeout)
+
+    def close(self):
+        with self.condition:
+            self.write_file.close()
+            if self.read_file:
+                self.read_file.close()
+
+    def _load_cursor(self, existing_segments) -> Tuple[int, int]:
+        cursor_path = os.path.join(self.directory, CURSOR_FILE_NAME)
+        if os.path.exists(cursor_path):
+            with open(cursor_path) as cursor_file:
+                cursor = json.load(cursor_file)
+            if cursor["segment"] in existing_segments:
+                return cursor["segment"], cursor["offset"]
+
+        if existing_segments:
+            return existing_segments[0], 0
+        return self.write_segment, 0
+
+    def _save_cursor(self):
+        cursor_path = os.path.join(self.directory, CURSOR_FILE_NAME)
+        with open(cursor_path + ".tmp", "w") as cursor_file:
+            json.dump({"segment": self.commit_segment, "offset": self.commit_offset}, cursor_file)
+        os.replace(cursor_path + ".tmp", cursor_path)
+
+    def _list_segments(self):
+        segments = []
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith(SEGMENT_PREFIX) and file_name.endswith(SEGMENT_SUFFIX):
+                segments.append(int(file_name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        return sorted(segments)
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{segment:012d}{SEGMENT_SUFFIX}")
+
+
+class InFlightBatch(object):
+    def __init__(self, data: bytes, segment: int, offset: int, future: pubsub_v1.publisher.futures.Future):
+        self.data = data
+        self.segment = segment
+        self.offset = offset
+        self.future = future
+
+
+class PubsubSpool(object):
+    """
+    Every batch gets written to a SegmentedLog first, and a background thread drains the log into Pub/Sub, keeping up
+    to max_in_flight publishes going at once. Batches are committed in log order as their publishes complete, and
+    failed publishes are retried with a backoff instead of being dropped. Batches Pub/Sub rejects outright are moved to
+    a dead letter file next to the segments instead. Anything which hasn't been published by the time the spool is
+    closed stays on disk and gets replayed the next time it is opened.
+    """
+
+    def __init__(self, directory: str, publisher: pubsub_v1.PublisherClient, topic_path: str, max_segment_bytes: int,
+                 publish_timeout: int, max_in_flight: int):
+        self.log = SegmentedLog(directory, max_segment_bytes)
+        self.publisher = publisher
+        self.topic_path = topic_path
+        self.publish_timeout = publish_timeout
+        self.max_in_flight = max_in_flight
+        # Guards users, closing and drainer, which are shared between the crawls using the spool and the drainer
+        self.state_lock = threading.Lock()
+        self.users = 0
+        self.closing = False
+        self.close_deadline = None
+        self.drainer = None
+
+    def append(self, data: bytes):
+        self.log.append(data)
+
+    def open(self):
+        with self.state_lock:
+            self.users += 1
+            # A crawl which starts while the spool is still draining for a previous one just keeps it going
+            self.closing = False
+            if self.drainer is None:
+                self.drainer = threading.Thread(target=self._drain, name=f"pubsub-spool-{self.topic_path}",
+                                                daemon=True)
+                self.drainer.start()
+
+    def release(self, timeout: int):
+        """
+        Waits up to timeout seconds for the spool to be drained once the last user has released it. Anything left over
+        is replayed on the next start
+        """
+        with self.state_lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+            self.closing = True
+            self.close_deadline = time.monotonic() + timeout
+            drainer = self.drainer
+        if drainer:
+            drainer.join(timeout + self.publish_timeout)
+
+    def is_closed(self) -> bool:
+        with self.state_lock:
+            return self.users == 0 and self.drainer is None
+
+    def _should_stop(self, caught_up: bool) -> bool:
+        with self.state_lock:
+            if not self.closing:
+                return False
+            if not caught_up and time.monotonic() <= self.close_deadline:
+                return False
+            if not caught_up:
+                logger.warning(f"Closing spool for {self.topic_path} before it was drained, will replay on next start")
+            self.drainer = None
+            return True
+
+    def _drain(self):
+        try:
+            self._drain_log()
+        except Exception:
+            # Clear the drainer, so the next crawl to open the spool starts a new one, and the spool can be closed
+            logger.exception(f"Spool drainer for {self.topic_path} failed, will retry on next open")
+            with self.state_lock:
+                self.drainer = None
+
+    def _drain_log(self):
+        # A previous drainer may have read records it never got to commit
+        self.log.rewind()
+        in_flight = deque()
+        backoff = 1
+        while True:
+            while len(in_flight) < self.max_in_flight:
+                next_record = self.log.read_next()
+                if next_record is None:
+                    break
+                data, segment, offset = next_record
+                in_flight.append(InFlightBatch(data, segment, offset, self._publish(data)))
+
+            if self._should_stop(caught_up=not in_flight):
+                return
+            if not in_flight:
+                self.log.wait(1)
+                continue
+
+            # Publishes can complete out of order, but the cursor can only move forward over a contiguous run of
+            # published batches, so always wait on the oldest one
+            oldest = in_flight[0]
+            try:
+                message_id = oldest.future.result(timeout=self.publish_timeout)
+            except NON_RETRYABLE_ERRORS as e:
+                self._dead_letter(oldest.data, e)
+            except Exception as e:
+                logger.warning(f"Publishing to {self.topic_path} failed, retrying in {backoff} seconds: {e!r}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_RETRY_BACKOFF_SECONDS)
+                oldest.future = self._publish(oldest.data)
+                continue
+            else:
+                logger.info(f"Published spooled batch {message_id} to {self.topic_path}")
+
+            self.log.commit(oldest.segment, oldest.offset)
+            in_flight.popleft()
+            backoff = 1
+
+    def _publish(self, data: bytes) -> pubsub_v1.publisher.futures.Future:
+        try:
+            return self.publisher.publish(self.topic_path, data=data)
+        except Exception as e:
+            # Some errors, like a batch being too large, are raised straight away instead of through the future. Put
+            # them in a future anyway, so they are retried or dead lettered in order like every other failure
+            future = pubsub_v1.publisher.futures.Future()
+            future.set_exception(e)
+            return future
+
+    def _dead_letter(self, data: bytes, error: Exception):
+        dead_letter_path = os.path.join(self.log.directory, DEAD_LETTER_FILE_NAME)
+        logger.error(f"Pub/Sub rejected a batch for {self.topic_path}, moving it to {dead_letter_path}: {error!r}")
+        with open(dead_letter_path, "ab") as dead_letter_file:
+            dead_letter_file.write(data + b"\n")
+
+
+def acquire_spool(directory: str, publisher: pubsub_v1.PublisherClient, topic_path: str, max_segment_bytes: int,
+                  publish_timeout: int, max_in_flight: int) -> PubsubSpool:
+    with _spools_lock:
+        spool = _spools.get(directory)
+        if spool is None:
+            spool = PubsubSpool(directory, publisher, topic_path, max_segment_bytes, publish_timeout, max_in_flight)
+            _spools[directory] = spool
+        spool.open()
+        return spool
+
+
+def release_spool(spool: PubsubSpool, timeout: int):
+    spool.release(timeout)
+    with _spools_lock:
+        # The spool stays registered until its drainer has actually stopped, so a crawl starting in the meantime picks
+        # it back up instead of opening a second log on the same directory
+        if spool.is_closed():
+            del _spools[spool.log.directory]
+            spool.log.close()